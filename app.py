@@ -3,67 +3,94 @@
 
 import streamlit as st
 import pandas as pd
-import yagmail
 import re
-import tempfile
-import os
 import base64
-from io import StringIO
+from io import BytesIO
 from streamlit_quill import st_quill
-from datetime import datetime
-import openpyxl
-from openpyxl.styles import Font, Border, Side
-from openpyxl.utils import get_column_letter
-import shutil
+from datetime import datetime, timedelta
 import time
 import socket
-import streamlit.components.v1 as components
+import smtplib
+import queue
+from functools import partial
+import mimetypes
+from email import encoders
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import formatdate, make_msgid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # EXCEL LOGGING FUNCTION (CLEAN FORMAT)
 
-def export_logs_excel(logs):
-    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"email_logs_{ts}.xlsx"
-    filepath = f"/tmp/{filename}"
-
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = "Email Logs"
+LOG_COLUMNS = ["Row", "Email", "Status", "Details", "Timestamp"]
 
-    headers = ["Row", "Email", "Status", "Details", "Timestamp"]
-    ws.append(headers)
+def new_logs():
+    # One list per column instead of one list per entry
+    return {col: [] for col in LOG_COLUMNS}
 
-    # Bold headers
-    for col in range(1, len(headers) + 1):
-        ws.cell(row=1, column=col).font = Font(bold=True)
+def add_log(logs, *values):
+    for column, value in zip(logs.values(), values):
+        column.append(value)
 
-    # Insert log rows
-    for row in logs:
-        ws.append(row)
+def log_batch(logs, idx, emails, refused, at):
+    for email_addr in emails:
+        if email_addr in refused:
+            add_log(logs, idx, email_addr, "FAILED", str(refused[email_addr]), at)
+        else:
+            add_log(logs, idx, email_addr, "SENT", "OK", at)
 
-    # Borders and auto-width
-    thin = Border(
-        left=Side(style="thin"),
-        right=Side(style="thin"),
-        top=Side(style="thin"),
-        bottom=Side(style="thin")
-    )
-
-    for row in ws.iter_rows():
-        for cell in row:
-            cell.border = thin
+def export_logs_excel(logs, started_at):
+    # Imported here so page renders before the first send don't load openpyxl
+    import openpyxl
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font, Border, Side, NamedStyle
+    from openpyxl.utils import get_column_letter
 
-    # Auto column width
-    for col in ws.columns:
-        max_len = 0
-        col_letter = get_column_letter(col[0].column)
-        for cell in col:
-            if cell.value:
-                max_len = max(max_len, len(str(cell.value)))
-        ws.column_dimensions[col_letter].width = max_len + 2
+    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+    filename = f"email_logs_{ts}.xlsx"
 
-    wb.save(filepath)
-    return filepath, filename
+    # Write-only workbook: rows stream out as they are appended
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("Email Logs")
+
+    headers = list(logs)
+
+    # One registered style for the header instead of per-cell style objects
+    thin = Side(style="thin")
+    wb.add_named_style(NamedStyle(
+        name="log_header",
+        font=Font(bold=True),
+        border=Border(left=thin, right=thin, top=thin, bottom=thin)
+    ))
+
+    # Auto column width (write-only sheets need it before any row is written)
+    for i, (header, values) in enumerate(logs.items(), start=1):
+        if header == "Timestamp":
+            # Every timestamp formats to the same width, so one sample is enough
+            max_len = len(started_at.isoformat(" ", "microseconds")) if values else 0
+        else:
+            max_len = max((len(str(v)) for v in values if v), default=0)
+        ws.column_dimensions[get_column_letter(i)].width = max(max_len, len(header)) + 2
+
+    # Bold, bordered headers
+    header_cells = []
+    for h in headers:
+        cell = WriteOnlyCell(ws, value=h)
+        cell.style = "log_header"
+        header_cells.append(cell)
+    ws.append(header_cells)
+
+    # Insert log rows as plain values (no per-cell style objects). Timestamps
+    # are logged as monotonic offsets and become datetimes as each row goes out.
+    for *row, ns in zip(*logs.values()):
+        ws.append((*row, started_at + timedelta(microseconds=ns // 1000)))
+
+    # Keep the file in memory; it goes straight to the download button
+    buf = BytesIO()
+    wb.save(buf)
+    buf.seek(0)
+    return buf, filename
 
 # CONFIG & STYLING
 
@@ -74,9 +101,11 @@ def get_base64_of_bin_file(bin_file):
         data = f.read()
     return base64.b64encode(data).decode()
 
-def set_png_as_page_bg(png_file):
+@st.cache_resource(show_spinner=False)
+def page_bg_css(png_file):
+    # Built once per image; every rerun shares the same immutable <style> string
     bin_str = get_base64_of_bin_file(png_file)
-    page_bg_img = f'''
+    return f'''
     <style>
     .stApp {{
         background-image: url("data:image/jpg;base64,{bin_str}");
@@ -121,7 +150,6 @@ def set_png_as_page_bg(png_file):
         box-shadow: 0 0 0 3px rgba(77, 171, 247, 0.2) !important;
     }}
 
-    /* Expander Styling - Robust Selector */
     /* Expander Styling - Robust Selector */
     [data-testid="stExpander"] details {{
         border-color: #ced4da !important;
@@ -260,7 +288,9 @@ def set_png_as_page_bg(png_file):
     }}
     </style>
     '''
-    st.markdown(page_bg_img, unsafe_allow_html=True)
+
+def set_png_as_page_bg(png_file):
+    st.markdown(page_bg_css(png_file), unsafe_allow_html=True)
 
 try:
     set_png_as_page_bg('UIDBC.jpg')
@@ -296,6 +326,10 @@ if "email" in st.query_params and st.session_state.saved_email is None:
 
 # FIELD DETECTION
 
+# One address: a run of non-separator characters around an "@"
+_EMAIL_PATTERN = r"[^\s,;/]+@[^\s,;/]+"
+_NORM_RE = re.compile(r"[^a-z0-9]")
+
 FIELD_MAP = {
     "email": ["email", "mail", "e-mail", "emailaddress", "emailid"],
     "name": ["name", "fullname", "full name", "nama", "nama lengkap"],
@@ -304,26 +338,27 @@ FIELD_MAP = {
 }
 
 def normalize(text):
-    return re.sub(r"[^a-z0-9]", "", text.lower())
+    return _NORM_RE.sub("", text.lower())
+
+NORM_ALIASES = {field: [normalize(a) for a in aliases] for field, aliases in FIELD_MAP.items()}
 
-def detect_columns(df):
+@st.cache_data(show_spinner=False)
+def detect_columns(columns):
     detected = {}
-    normalized_cols = {normalize(c): c for c in df.columns}
+    normalized_cols = {normalize(c): c for c in columns}
 
-    for field, aliases in FIELD_MAP.items():
+    for field, alias_norms in NORM_ALIASES.items():
 
-        # Hard match for email
-        if field == "email":
-            for norm, real in normalized_cols.items():
-                if norm == "email":
-                    detected[field] = real
-                    break
-            if field in detected:
-                continue
+        # Exact alias match (covers the hard "email" match)
+        for alias_norm in alias_norms:
+            if alias_norm in normalized_cols:
+                detected[field] = normalized_cols[alias_norm]
+                break
+        if field in detected:
+            continue
 
-        # Alias matching
-        for alias in aliases:
-            alias_norm = normalize(alias)
+        # Substring fallback
+        for alias_norm in alias_norms:
             for norm, real in normalized_cols.items():
                 if alias_norm in norm or norm in alias_norm:
                     detected[field] = real
@@ -333,6 +368,160 @@ def detect_columns(df):
 
     return detected
 
+@st.cache_data(show_spinner=False)
+def load_recipients(file_bytes):
+    # Stream values with openpyxl's read-only reader (no styles or cell
+    # objects) and keep only the columns detect_columns picks out
+    import openpyxl
+
+    wb = openpyxl.load_workbook(BytesIO(file_bytes), read_only=True, data_only=True)
+    try:
+        # First sheet, as pd.read_excel did; wb.active is whichever tab was open
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        # Blank headers stay None and are never offered to detect_columns
+        headers = [None if h is None else str(h) for h in next(rows, ())]
+        detected = detect_columns(tuple(h for h in headers if h is not None))
+        columns = list(dict.fromkeys(detected.values()))
+        positions = [headers.index(col) for col in columns]
+
+        # Blank rows inside the sheet keep their place so logged Row numbers
+        # match pd.read_excel; only trailing blank rows are dropped
+        data = {col: [] for col in columns}
+        n_rows = 0
+        for i, row in enumerate(rows):
+            if any(v is not None for v in row):
+                n_rows = i + 1
+            for col, pos in zip(columns, positions):
+                v = row[pos] if pos < len(row) else None
+                data[col].append(None if v is None else str(v))
+    finally:
+        wb.close()
+
+    data = {col: values[:n_rows] for col, values in data.items()}
+    return pd.DataFrame(data, index=pd.RangeIndex(n_rows)), detected
+
+# TEMPLATE RENDERING
+
+def active_fields(template, fields):
+    # Placeholders the template actually uses; the rest never need substituting
+    return [f for f in fields if f"{{{f}}}" in template]
+
+def compile_template(template, fields):
+    if not fields:
+        return lambda values: template
+
+    # Split once into literal chunks and placeholder slots: [lit, slot, lit, ...]
+    pattern = re.compile(r"\{(" + "|".join(map(re.escape, fields)) + r")\}")
+    parts = pattern.split(template)
+    literals = parts[0::2]
+    slots = parts[1::2]
+
+    def render(values):
+        out = [literals[0]]
+        for slot, literal in zip(slots, literals[1:]):
+            out.append(values[slot])
+            out.append(literal)
+        return "".join(out)
+
+    return render
+
+# SMTP SENDING
+
+SMTP_HOST = "smtp.gmail.com"
+SMTP_PORT = 465
+SMTP_CONNECTIONS = 5  # Default pool size; Gmail tolerates about 15
+MAX_SMTP_CONNECTIONS = 15
+KEEPALIVE_EVERY = 50  # Sends between NOOP health checks on a connection
+SEND_ATTEMPTS = 3
+
+def open_connection(user, password):
+    smtp = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT)
+    smtp.login(user, password)
+    return smtp
+
+def close_connection(smtp):
+    try:
+        smtp.quit()
+    except (smtplib.SMTPException, OSError):
+        pass
+
+def is_alive(smtp):
+    try:
+        return smtp.noop()[0] == 250
+    except (smtplib.SMTPException, OSError):
+        return False
+
+def build_attachments(files):
+    # Read and base64-encode each upload once; the parts are shared by every message
+    parts = []
+    for file in files:
+        ctype, _ = mimetypes.guess_type(file.name)
+        maintype, subtype = (ctype or "application/octet-stream").split("/", 1)
+        part = MIMEBase(maintype, subtype)
+        file.seek(0)
+        part.set_payload(file.read())
+        encoders.encode_base64(part)
+        part.add_header("Content-Disposition", "attachment", filename=file.name)
+        parts.append(part)
+    return parts
+
+def send_batch(smtp, sender, recipients, subject, body, attachments):
+    # One DATA command with a RCPT TO per recipient; returns refused addresses.
+    # Co-recipients of a row are left out of the headers so they stay private.
+    msg = MIMEMultipart()
+    msg["From"] = sender
+    msg["To"] = recipients[0] if len(recipients) == 1 else "undisclosed-recipients:;"
+    msg["Subject"] = subject
+    msg["Date"] = formatdate(localtime=True)
+    msg["Message-ID"] = make_msgid(domain=sender.rpartition("@")[2])
+    msg.attach(MIMEText(body, "html", "utf-8"))
+    for part in attachments:
+        msg.attach(part)
+    return smtp.sendmail(sender, recipients, msg.as_string())
+
+def send_with_retry(conn, connect, *args):
+    # Back off exponentially on dropped sessions and 4xx (transient) replies
+    # such as 421 rate limiting. conn is a one-item list holding the session,
+    # so a reconnect reaches the caller even if the retry then fails.
+    for attempt in range(SEND_ATTEMPTS):
+        try:
+            return send_batch(conn[0], *args)
+        except smtplib.SMTPServerDisconnected:
+            if attempt == SEND_ATTEMPTS - 1:
+                raise
+            time.sleep(2 ** attempt)
+            close_connection(conn[0])
+            conn[0] = connect()
+        except smtplib.SMTPResponseException as err:
+            if not 400 <= err.smtp_code < 500 or attempt == SEND_ATTEMPTS - 1:
+                raise
+            time.sleep(2 ** attempt)
+
+def send_row(connections, connect, sender, emails, subject, body, attachments):
+    # Runs on a worker thread: borrow a connection, send, hand it back
+    smtp, sent = connections.get()
+    conn = [smtp]
+    try:
+        # Fixed small safety delay
+        time.sleep(1)
+
+        if sent and sent % KEEPALIVE_EVERY == 0 and not is_alive(conn[0]):
+            close_connection(conn[0])
+            conn[0] = connect()
+
+        refused = send_with_retry(
+            conn, connect, sender, emails, subject, body, attachments
+        )
+        sent += 1
+        return refused
+    except smtplib.SMTPRecipientsRefused as err:
+        return err.recipients
+    except Exception as err:
+        return {e: err for e in emails}
+    finally:
+        # Whatever session is current goes back, including a fresh reconnect
+        connections.put((conn[0], sent))
+
 # QUILL SETUP
 
 if "body_html" not in st.session_state:
@@ -402,8 +591,7 @@ detected_fields = {}
 
 if uploaded_excel:
     try:
-        df = pd.read_excel(uploaded_excel)
-        detected_fields = detect_columns(df)
+        df, detected_fields = load_recipients(uploaded_excel.getvalue())
         st.success(f"Excel uploaded — {len(df)} rows found.")
         st.info(f"Detected fields: {detected_fields}")
     except Exception as e:
@@ -420,12 +608,13 @@ if st.button("Show Preview"):
         preview = st.session_state.body_html
 
         if df is not None and len(df) > 0:
-            first = df.iloc[0]
-            for field, col in detected_fields.items():
-                preview = preview.replace(
-                    f"{{{field}}}",
-                    "" if pd.isna(first[col]) else str(first[col])
-                )
+            # Cells are strings or missing (None/NaN); read just the first one
+            fields = active_fields(preview, detected_fields)
+            values = {}
+            for field in fields:
+                v = df[detected_fields[field]].iat[0]
+                values[field] = v if isinstance(v, str) else ""
+            preview = compile_template(preview, fields)(values)
 
         st.markdown("### Email Preview")
         st.markdown(preview, unsafe_allow_html=True)
@@ -443,6 +632,13 @@ uploaded_files = st.file_uploader(
 
 st.header("6. Send Emails")
 
+concurrency = st.number_input(
+    "Concurrency (parallel SMTP connections)",
+    min_value=1,
+    max_value=MAX_SMTP_CONNECTIONS,
+    value=SMTP_CONNECTIONS
+)
+
 if st.button("🚀 Send Now"):
     if df is None:
         st.error("Please upload an Excel file.")
@@ -464,78 +660,126 @@ if st.button("🚀 Send Now"):
         st.error("Email body cannot be empty.")
         st.stop()
 
-    # Save attachments temporarily
-    temp_dir = tempfile.mkdtemp()
-    temp_paths = []
-
-    for file in uploaded_files:
-        file_path = os.path.join(temp_dir, file.name)
-        with open(file_path, "wb") as f:
-            f.write(file.read())
-        temp_paths.append(file_path)
+    # Encode attachments once for all recipients
+    attachments = build_attachments(uploaded_files)
 
     # Connect SMTP
     socket.setdefaulttimeout(60)  # Global timeout to prevent hanging
 
+    connect = partial(open_connection, email_user, email_pass)
+    # No point opening more connections than there are rows to send
+    pool_size = max(1, min(int(concurrency), len(df)))
+    connections = queue.Queue()
     try:
-        yag = yagmail.SMTP(email_user, email_pass)
+        for _ in range(pool_size):
+            connections.put((connect(), 0))
     except Exception as e:
+        while not connections.empty():
+            close_connection(connections.get()[0])
         st.error(f"SMTP Login Failed: {e}")
         st.stop()
 
-    logs = []
+    logs = new_logs()
     total = len(df)
     progress = st.progress(0)
+    step = max(1, total // 100)  # Redraw the bar at most ~100 times
     count = 0
+    attempted = 0
+    failures = 0
+    started_at = datetime.utcnow()
+    started_ns = time.monotonic_ns()
+
+    # Plain object arrays per field, with missing cells already blank
+    field_arrays = {
+        field: df[col].to_numpy(dtype=object, na_value="")
+        for field, col in detected_fields.items()
+    }
+    # Extract every row's addresses in one vectorized pass
+    email_lists = df[detected_fields["email"]].fillna("").str.findall(_EMAIL_PATTERN).tolist()
+    row_labels = df.index.tolist()
+
+    # Bodies come from the pre-split template, rendered once per distinct
+    # combination of placeholder values
+    template = st.session_state.body_html
+    key_fields = active_fields(template, field_arrays)
+    render = compile_template(template, key_fields)
+    key_arrays = [field_arrays[f] for f in key_fields]
+    rendered = {}
+
+    pool = ThreadPoolExecutor(max_workers=pool_size)
+    futures = {}
+    logged = set()
+    aborted = False
+    try:
+        for i in range(total):
+            idx = row_labels[i]
+
+            emails = email_lists[i]
 
-    email_col = detected_fields["email"]
+            if not emails:
+                add_log(logs, idx, "", "NO_EMAIL", "SKIPPED", time.monotonic_ns() - started_ns)
+                count += 1
+                if count % step == 0 or count == total:
+                    progress.progress(count / total)
+                continue
 
-    for idx, row in df.iterrows():
-        body = st.session_state.body_html
+            # Only render once we know the row will actually be sent
+            key = tuple(values[i] for values in key_arrays)
+            body = rendered.get(key)
+            if body is None:
+                body = rendered[key] = render(dict(zip(key_fields, key)))
 
-        for field, col in detected_fields.items():
-            body = body.replace(
-                f"{{{field}}}",
-                "" if pd.isna(row[col]) else str(row[col])
+            # Addresses from the same row share a body, so send them as one batch
+            future = pool.submit(
+                send_row, connections, connect, email_user,
+                emails, subject, body, attachments
             )
+            futures[future] = (idx, emails)
 
-        # Split multiple emails
-        raw_emails = re.split(r"[\/,; ]+", str(row[email_col]))
-        emails = [e for e in raw_emails if "@" in e]
+        # Progress and logs are only touched from the script thread
+        for future in as_completed(futures):
+            idx, emails = futures[future]
+            refused = future.result()
+            done_at = time.monotonic_ns() - started_ns  # One timestamp for the whole batch
+            log_batch(logs, idx, emails, refused, done_at)
+            logged.add(future)
 
-        if not emails:
-            logs.append([idx, "", "NO_EMAIL", "SKIPPED", datetime.utcnow()])
             count += 1
-            progress.progress(count / total)
-            continue
-
-        for email_addr in emails:
-            # Fixed small safety delay
-            time.sleep(1)
-
-            try:
-                yag.send(
-                    to=email_addr,
-                    subject=subject,
-                    contents=body,
-                    attachments=temp_paths
-                )
-                logs.append([idx, email_addr, "SENT", "OK", datetime.utcnow()])
-            except Exception as err:
-                logs.append([idx, email_addr, "FAILED", str(err), datetime.utcnow()])
+            if count % step == 0 or count == total:
+                progress.progress(count / total)
+
+            # Abort if more than a third of a meaningful sample failed
+            attempted += len(emails)
+            failures += len(refused)
+            if attempted >= 30 and failures * 3 > attempted:
+                aborted = True
+                st.warning(f"Stopped after {failures} of {attempted} sends failed.")
+                break
+    finally:
+        # Drop queued rows but let in-flight ones finish, then log both so
+        # every submitted row shows up even if the run stopped early
+        pool.shutdown(wait=True, cancel_futures=True)
+        stopped_at = time.monotonic_ns() - started_ns
+        for future, (idx, emails) in futures.items():
+            if future in logged:
+                continue
+            if future.cancelled():
+                for email_addr in emails:
+                    add_log(logs, idx, email_addr, "ABORTED", "NOT SENT", stopped_at)
+            else:
+                log_batch(logs, idx, emails, future.result(), stopped_at)
 
-        count += 1
-        progress.progress(count / total)
+        while not connections.empty():
+            close_connection(connections.get()[0])
 
     # EXPORT CLEAN EXCEL LOG
-    excel_path, excel_name = export_logs_excel(logs)
-
-    st.success("All emails processed!")
-    with open(excel_path, "rb") as f:
-        st.download_button("📥 Download Logs (Excel)", f, file_name=excel_name)
-
-    # Cleanup temp files
-    try:
-        shutil.rmtree(temp_dir)
-    except:
-        pass
+    excel_buf, excel_name = export_logs_excel(logs, started_at)
+
+    if not aborted:
+        st.success("All emails processed!")
+    st.download_button(
+        "📥 Download Logs (Excel)",
+        excel_buf,
+        file_name=excel_name,
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    )